@@ -1,7 +1,7 @@
-from distutils.core import setup
+from setuptools import setup
 setup(
     name='starfuse',
-    packages=['starfuse', 'starfuse.pak', 'starfuse.pak', 'starfuse.fs'],
+    packages=['starfuse', 'starfuse.pak', 'starfuse.fs'],
     version='0.3.0',
     description='Mount StarBound .pak files as FUSE filesystems',
     author='Josh Junon',
@@ -18,7 +18,10 @@ class Config(object):
         parser.add_argument('mount_dir', type=str, help='the directory on which to mount the PAK file')
         parser.add_argument('-v', '--verbose', help='be noisy', action='store_true')
         parser.add_argument('-w', '--write', help='allow modifications to the .pak file', action='store_true')
-        parser.add_argument('--pages', type=int, help='map this number of pages at a time (default: 256)', default=256)
+        parser.add_argument('--pages', type=int, help='map this number of pages at a time; must be a power of two; 64-bit systems map the whole file at once (default: 256)', default=256)
+        parser.add_argument('--index-cache', help='cache the file index next to the .pak file to speed up later mounts', action='store_true')
+        parser.add_argument('--max-maps', type=int, help='keep at most this many mappings open at once (default: 16)', default=16)
+        parser.add_argument('--cache-size', type=int, help='keep up to this many MiB of recently read files in memory (default: 64)', default=64)
 
         self._args = parser.parse_args()
 
@@ -42,6 +45,21 @@ class Config(object):
         """Gets the number of pages to map at once"""
         return self._args.pages
 
+    @property
+    def max_maps(self):
+        """Gets the maximum number of mappings to keep open at once"""
+        return self._args.max_maps
+
+    @property
+    def cache_size(self):
+        """Gets the number of bytes of file contents to keep cached"""
+        return self._args.cache_size * 1024 * 1024
+
+    @property
+    def index_cache(self):
+        """Whether or not to cache the file index next to the .pak file"""
+        return self._args.index_cache
+
     @property
     def read_only(self):
         """Whether or not the file is read-only protected"""
@@ -6,11 +6,30 @@ of memory. Allows memory to be accessed via array reads/
 writes as well.
 """
 
+import os
+import sys
 import mmap
 import logging
+from collections import OrderedDict
 
 log = logging.getLogger(__name__)
 
+# madvise() is only available on Python 3.8+ (and not on every platform)
+MADV_RANDOM = getattr(mmap, 'MADV_RANDOM', None)
+MADV_SEQUENTIAL = getattr(mmap, 'MADV_SEQUENTIAL', None)
+
+# the posix_fadvise() counterparts of the madvise() hints, for the reads that
+# go through the file descriptor instead of the mappings
+_FADVISE = dict()
+if hasattr(os, 'posix_fadvise'):
+    if MADV_RANDOM is not None:
+        _FADVISE[MADV_RANDOM] = os.POSIX_FADV_RANDOM
+    if MADV_SEQUENTIAL is not None:
+        _FADVISE[MADV_SEQUENTIAL] = os.POSIX_FADV_SEQUENTIAL
+
+# whether there's enough address space to map whole files at once
+_WIDE_ADDRESS_SPACE = sys.maxsize > 2 ** 32
+
 
 class ReadOnlyError(Exception):
     """The mapped file is flagged as read-only"""
@@ -42,7 +61,11 @@ class Region(object):
         return self.__size
 
     def __str__(self):
-        return str(self.read(offset=0, length=len(self)))
+        return '<Region base=%d size=%d cursor=%d>' % (self.base_offset, len(self), self.cursor)
+
+    def to_bytes(self):
+        """Reads the entire region"""
+        return self.read(offset=0, length=len(self), advance=False)
 
     def __enter__(self):
         return self
@@ -68,6 +91,7 @@ class Region(object):
         return (offset, length)
 
     def read(self, length=-1, offset=-1, advance=True):
+        """Reads data from the region, returning bytes"""
         (offset, length) = self._sanitize_segment(offset, length)
         offset += self.base_offset
         result = self.parent.read(length, offset, advance=advance)
@@ -75,12 +99,22 @@ class Region(object):
             self.cursor += len(result)
         return result
 
+    def view(self, length=-1, offset=-1, advance=True):
+        """Gets a memoryview of data in the region, without copying it where possible"""
+        (offset, length) = self._sanitize_segment(offset, length)
+        offset += self.base_offset
+        result = self.parent.view(length, offset, advance=advance)
+        if advance:
+            self.cursor += len(result)
+        return result
+
     def write(self, value, length=-1, offset=-1, advance=True):
+        """Writes a bytes-like object to the region, returning the number of bytes written"""
         if length < 0:
             length = len(value)
-        (offset, length) = self._sanitaize_segment(offset, length)
+        (offset, length) = self._sanitize_segment(offset, length)
         offset += self.base_offset
-        result = self.parent.write(value, length, offset, advance=advance)
+        result = self.parent.write(value, offset=offset, length=length, advance=advance)
         if advance:
             self.cursor += result
         return result
@@ -90,9 +124,11 @@ class MappedFile(Region):
     """Manages mmap()-ings of a file into vmem.
 
     This class prevents virtual address space from growing too large by
-    re-using existing maps if the requested regions have already been mapped.
+    re-using existing maps if the requested regions have already been mapped,
+    and by unmapping the least recently used pages once more than `max_pages`
+    of them are mapped at a time.
     """
-    def __init__(self, path, page_count, read_only=False):
+    def __init__(self, path, page_count, read_only=False, max_pages=16):
         # XXX TODO NOTE remove this line when write functionality is added.
         read_only = True
 
@@ -103,8 +139,42 @@ class MappedFile(Region):
         # make sure we're sane here - allocation granularity needs to divide into page size!
         assert (self._page_size % mmap.ALLOCATIONGRANULARITY) == 0, 'page size is not a multiple of allocation granularity!'
 
-        self._file = open(path, 'r+b')
-        self._pages = dict()
+        # page size is a power of two, so page math can be done with shifts and masks
+        assert (self._page_size & (self._page_size - 1)) == 0, 'page size is not a power of two!'
+
+        self._file = open(path, 'rb' if read_only else 'r+b')
+        self._filesize = os.fstat(self._file.fileno()).st_size
+
+        # with a 64-bit address space there's no need to window the file at
+        # all; grow the page so the whole thing is one mapping (still a power
+        # of two, so it's still a multiple of the allocation granularity).
+        if _WIDE_ADDRESS_SPACE and self._filesize > self._page_size:
+            self._page_size = 1 << (self._filesize - 1).bit_length()
+            log.debug('mapping whole file as one page: size=%d', self._page_size)
+
+        self._page_shift = self._page_size.bit_length() - 1
+        self._page_mask = self._page_size - 1
+
+        # page IDs are dense, so they index straight into a list; the
+        # ordered dict only tracks which ones are mapped, oldest first.
+        page_total = (self._filesize + self._page_size - 1) // self._page_size
+        self._pages = [None] * page_total
+        self._mapped = OrderedDict()
+
+        # indexing/slicing a memoryview is cheaper than doing so on the mmap
+        # itself, so every mapped page keeps one around.
+        self._views = [None] * page_total
+        # there has to be room for at least the page being accessed
+        self._max_pages = max(1, max_pages)
+
+        # lookups land all over the file; don't let the kernel read ahead for
+        # us unless told otherwise (see access_pattern()).
+        self._map_advice = None
+        self.access_pattern(MADV_RANDOM)
+
+        # most accesses land in the same page as the last one
+        self._cache_id = -1
+        self._cache_page = None
 
         self.read_only = read_only
         self._path = path
@@ -113,70 +183,197 @@ class MappedFile(Region):
         super(MappedFile, self).__init__(self, base_offset=0, size=len(self))
 
     def __len__(self):
-        self._file.seek(0, 2)
-        size = self._file.tell()
-        return size
+        return self._filesize
 
     def __del__(self):
         self.close()
 
     def close(self):
         """Unmaps all mappings"""
-        for i in self._pages:
-            self._pages[i].close()
+        self._cache_id = -1
+        self._cache_page = None
+        for i in self._mapped:
+            self._unmap_page(i)
+        self._mapped.clear()
         self._file.close()
 
     def region(self, offset, size):
-        """Requests a virtual region be 'allocated'"""
-        lower_page = offset - (offset % self._page_size)
-        upper_page = ((offset + size) // self._page_size) * self._page_size
-        lower_page_id = lower_page // self._page_size
-        upper_page_id = upper_page // self._page_size
-
-        # make sure we're mapped
-        for i in range(lower_page_id, upper_page_id + 1):
-            if i not in self._pages:
-                page_offset = i * self._page_size
-                page_size = min(self._page_size, len(self) - page_offset)
-                log.debug('mapping vfile page: id=%d offset=%d size=%d', i, page_offset, page_size)
-                self._pages[i] = mmap.mmap(self._file.fileno(), offset=page_offset, length=page_size)
-
-        # create a region
+        """Requests a virtual region be 'allocated'
+
+        Pages are mapped lazily as the region is accessed."""
         return Region(self, base_offset=offset, size=size)
 
+    def _map_page(self, i):
+        """Maps the page with the given ID into memory"""
+        # evict the least recently used page(s) if we're at capacity
+        while len(self._mapped) >= self._max_pages:
+            (old_id, _) = self._mapped.popitem(last=False)
+            log.debug('unmapping vfile page: id=%d', old_id)
+            if old_id == self._cache_id:
+                self._cache_id = -1
+                self._cache_page = None
+            self._unmap_page(old_id)
+
+        page_offset = i << self._page_shift
+        page_size = min(self._page_size, len(self) - page_offset)
+        log.debug('mapping vfile page: id=%d offset=%d size=%d', i, page_offset, page_size)
+        # read-only maps keep the kernel from setting up for writes we'll never make
+        access = mmap.ACCESS_READ if self.read_only else mmap.ACCESS_WRITE
+        page = mmap.mmap(self._file.fileno(), offset=page_offset, length=page_size, access=access)
+
+        if self._map_advice is not None:
+            page.madvise(self._map_advice)
+
+        view = memoryview(page)
+        self._pages[i] = page
+        self._views[i] = view
+        self._mapped[i] = None
+        return view
+
+    def _unmap_page(self, i):
+        """Unmaps the page with the given ID"""
+        self._views[i].release()
+        self._views[i] = None
+        try:
+            self._pages[i].close()
+        except BufferError:
+            # somebody still holds a view into this page (see view()); the
+            # mapping goes away on its own once the last of those does.
+            pass
+        self._pages[i] = None
+
+    def _get_page(self, i):
+        """Gets a view of a mapped page by its ID, mapping it if necessary"""
+        if i == self._cache_id:
+            return self._cache_page
+
+        page = self._views[i]
+        if page is None:
+            page = self._map_page(i)
+        else:
+            self._mapped.move_to_end(i)
+
+        self._cache_id = i
+        self._cache_page = page
+        return page
+
     def read(self, length=1, offset=-1, advance=True):
-        """Reads data from the virtual region"""
+        """Reads data from the virtual region, returning bytes"""
         (offset, length) = self._sanitize_segment(offset, length)
 
-        results = []
-        length = min(length, len(self))
+        length = min(length, len(self) - offset)
+
+        rel_offset = offset & self._page_mask
+        if rel_offset + length <= self._page_size:
+            # the common case: it's all in one page, so copy it out directly
+            result = bytes(self._get_page(offset >> self._page_shift)[rel_offset:rel_offset + length])
 
-        abs_offset = offset
-        cur_page = abs_offset // self._page_size
-        abs_offset %= self._page_size
+        # large reads skip the mappings entirely; a single pread() is cheaper
+        # than mapping (and likely evicting) several pages just to copy them out.
+        elif length > self._page_size // 2 and hasattr(os, 'pread'):
+            result = os.pread(self._file.fileno(), length, offset)
+        else:
+            # a small read straddling a page boundary; stitch it together
+            # from the pages it spans
+            buffer = bytearray(length)
+            self._copy_mapped(memoryview(buffer), offset, length)
+            result = bytes(buffer)
 
+        if advance:
+            self.cursor += len(result)
+        return result
+
+    def view(self, length=-1, offset=-1, advance=True):
+        """Gets a memoryview of data in the virtual region
+
+        If the data lies within a single page, the view points straight into
+        the mapping and nothing is copied; otherwise it's a view of a copy.
+        A view keeps its page mapped for as long as it's alive."""
+        (offset, length) = self._sanitize_segment(offset, length)
+        length = min(length, len(self) - offset)
+
+        rel_offset = offset & self._page_mask
+        if rel_offset + length <= self._page_size:
+            result = self._get_page(offset >> self._page_shift)[rel_offset:rel_offset + length]
+            if advance:
+                self.cursor += length
+            return result
+
+        return memoryview(self.read(length, offset, advance=advance))
+
+    def _copy_mapped(self, view, offset, length):
+        """Copies a range of the file out of the mapped pages into a memoryview"""
+        cur_page = offset >> self._page_shift
+        abs_offset = offset & self._page_mask
+
+        pos = 0
         while length > 0:
             readable = self._page_size - abs_offset
             readable = min(readable, length)
 
-            results.append(self._pages[cur_page][abs_offset:abs_offset + readable])
+            view[pos:pos + readable] = self._get_page(cur_page)[abs_offset:abs_offset + readable]
 
+            pos += readable
             length -= readable
             abs_offset = 0
             cur_page += 1
 
-        result = ''.join(results)
-        if advance:
-            self.cursor += len(result)
-        return result
+    def access_pattern(self, option):
+        """Sets the madvise() hint given to every mapping, current and future
+
+        `option` is one of the mmap.MADV_* constants (MADV_RANDOM by default);
+        the file descriptor gets the matching posix_fadvise() hint too, since
+        large reads bypass the mappings. This is a no-op if madvise() isn't
+        supported."""
+        if option is None:
+            return
+
+        self._map_advice = option
+        for i in self._mapped:
+            self._pages[i].madvise(option)
+
+        fadvice = _FADVISE.get(option)
+        if fadvice is not None:
+            os.posix_fadvise(self._file.fileno(), 0, 0, fadvice)
+
+    def prefetch(self, offset, length):
+        """Asynchronously pages a range of the file into the page cache"""
+        if offset >= len(self) or not hasattr(os, 'posix_fadvise'):
+            return
+        length = min(length, len(self) - offset)
+        os.posix_fadvise(self._file.fileno(), offset, length, os.POSIX_FADV_WILLNEED)
 
     def write(self, value, offset=-1, length=-1, advance=True):
+        """Writes a bytes-like object to the virtual region, returning the number of bytes written"""
         if self.read_only:
             raise ReadOnlyError(self._path)
 
-        # TODO
-        assert False, 'not implemented'
-        return 0
+        source = memoryview(value)
+        if length < 0:
+            length = len(source)
+        (offset, length) = self._sanitize_segment(offset, length)
+        length = min(length, len(source))
+
+        # mappings can't grow the file
+        if offset + length > len(self):
+            raise RegionOverflowError(offset + length)
+
+        pos = 0
+        cur_page = offset >> self._page_shift
+        rel_offset = offset & self._page_mask
+
+        while pos < length:
+            writable = min(self._page_size - rel_offset, length - pos)
+
+            self._get_page(cur_page)[rel_offset:rel_offset + writable] = source[pos:pos + writable]
+
+            pos += writable
+            rel_offset = 0
+            cur_page += 1
+
+        if advance:
+            self.cursor += length
+        return length
 
     def __getitem__(self, offset):
         if isinstance(offset, slice):
@@ -192,9 +389,9 @@ class MappedFile(Region):
         if offset >= len(self):
             raise RegionOverflowError(offset)
 
-        page = offset // self._page_size
-        rel_offset = offset % self._page_size
-        return self._pages[page][rel_offset]
+        page = offset >> self._page_shift
+        rel_offset = offset & self._page_mask
+        return self._get_page(page)[rel_offset]
 
     def __setitem__(self, offset, value):
         if self.read_only:
@@ -209,6 +406,6 @@ class MappedFile(Region):
         if offset >= len(self):
             raise RegionOverflowError(offset)
 
-        page = offset // self._page_size
-        rel_offset = offset % self._page_size
-        self._pages[page][rel_offset] = value
+        page = offset >> self._page_shift
+        rel_offset = offset & self._page_mask
+        self._get_page(page)[rel_offset] = value
@@ -3,6 +3,7 @@
 import os
 import os.path
 import logging
+from sys import intern
 
 assert os.sep == '/', 'Starfuse cannot be used on non-unix systems'
 
@@ -36,7 +37,51 @@ class VFS(object):
                 raise IsADirError(abspath)
             return
 
-        direc[filename] = lookup
+        # the same few names ('items', 'objects', ...) show up all over the
+        # tree; share one string object between all of them
+        direc[intern(filename)] = lookup
+
+    def add_files(self, files):
+        """Adds many (abspath, lookup) pairs at once, making directories as needed
+
+        Paths are added in sorted order so that neighbouring paths share their
+        leading directories, which are then only walked/created once."""
+        open_names = []
+        open_dirs = [self.root]
+
+        for abspath, lookup in sorted(files, key=lambda item: item[0]):
+            names = self._split_path(abspath)
+            dirnames = names[:-1]
+
+            # keep as much of the previous path's directories as we can
+            common = 0
+            limit = min(len(open_names), len(dirnames))
+            while common < limit and open_names[common] == dirnames[common]:
+                common += 1
+            del open_names[common:]
+            del open_dirs[common + 1:]
+
+            direc = open_dirs[-1]
+            for name in dirnames[common:]:
+                # files without a digest (Assets1) are stored as None, so
+                # go by membership rather than by value
+                if name not in direc:
+                    child = direc[intern(name)] = dict()
+                else:
+                    child = direc[name]
+                    if not isinstance(child, dict):
+                        raise NotADirError(abspath)
+                open_names.append(name)
+                open_dirs.append(child)
+                direc = child
+
+            filename = names[-1]
+            if filename in direc:
+                if isinstance(direc[filename], dict):
+                    raise IsADirError(abspath)
+                continue
+
+            direc[intern(filename)] = lookup
 
     def lookup_file(self, abspath):
         names = self._split_path(abspath)
@@ -54,7 +99,7 @@ class VFS(object):
             if name not in cur:
                 if not mkdirs:
                     raise FileNotFoundError(srcpath)
-                cur[name] = dict()
+                cur[intern(name)] = dict()
             elif not isinstance(cur, dict):
                 raise NotADirError(srcpath)
             cur = cur[name]
@@ -16,7 +16,9 @@ log = logging.getLogger(__name__)
 def fuse_op(fn):
     def handled_fn(*args, **kwargs):
         try:
-            return fn(*args, **kwargs)
+            # the pakfile unmaps pages as it goes; don't let threads race it
+            with args[0]._lock:
+                return fn(*args, **kwargs)
         except FileNotFoundError as e:
             raise FuseOSError(errno.ENOENT)
         except IsADirError as e:
@@ -24,17 +26,25 @@ def fuse_op(fn):
         except NotADirError as e:
             raise FuseOSError(errno.ENOTDIR)
         except Exception as e:
-            log.exception('EIO: %s', e.message)
+            log.exception('EIO: %s', e)
             raise FuseOSError(errno.EIO)
     return handled_fn
 
 
 class FusePAK(LoggingMixIn, Operations):
     """FUSE operations implementation for StarBound PAK files"""
-    def __init__(self, pakfile, page_count, read_only=False):
-        self.pakfile = Pakfile(pakfile, page_count, read_only=read_only)
+    def __init__(self, pakfile, page_count, read_only=False, max_pages=16, index_cache=False, cache_size=None):
+        self.pakfile = Pakfile(pakfile, page_count, read_only=read_only, max_pages=max_pages, index_cache=index_cache,
+                               cache_size=cache_size)
         self._lock = Lock()
 
+    def __call__(self, op, *args):
+        # LoggingMixIn repr()s every argument and return value (file contents
+        # included) whether or not debug logging is on; skip it unless it is.
+        if self.log.isEnabledFor(logging.DEBUG):
+            return LoggingMixIn.__call__(self, op, *args)
+        return Operations.__call__(self, op, *args)
+
     def make_file_struct(self, size, isfile=True, ctime=time(), mtime=time(), atime=time(), read_only=False):
         stats = dict()
         # TODO replace uncommented modes with commented when write ability is added
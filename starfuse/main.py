@@ -17,6 +17,7 @@ def main():
     """StarFuse entry point"""
     log.info('starting StarFuse')
     log.info('mounting pakfile %s as %s', config.pak_file, ('read-only' if config.read_only else 'read/write'))
-    pak = FusePAK(config.pak_file, page_count=config.page_count, read_only=config.read_only)
+    pak = FusePAK(config.pak_file, page_count=config.page_count, read_only=config.read_only, max_pages=config.max_maps,
+                  index_cache=config.index_cache, cache_size=config.cache_size)
     log.info('mounting on %s', config.mount_dir)
     FUSE(pak, config.mount_dir, foreground=True)
@@ -6,9 +6,9 @@ this implementation's sine qua non.
 """
 import binascii
 import bisect
-import io
 import struct
 import logging
+from collections import OrderedDict
 
 import starfuse.pak.sbon as sbon
 from starfuse.pak.sbbf03 import SBBF03
@@ -21,38 +21,24 @@ except:
 
 log = logging.getLogger(__name__)
 
+# formats are compiled once up front rather than re-parsed on every block
+_INT = struct.Struct('>i')
+_DB_FIELDS = struct.Struct('>i?xi?xxxi?')
+_INDEX_HEADER = struct.Struct('>Bii')
 
-class BTreeKeyError(Exception):
-    def __init__(self, key):
-        super(BTreeKeyError, self).__init__(key)
-
-
-def keyed(fn):
-    def wrapper(*args, **kwargs):
-        raw_key = False
-        key = None
-        try:
-            if 'raw_key' in kwargs:
-                raw_key = kwargs['raw_key']
-                del kwargs['raw_key']
-
-            self = args[0]
-            key = args[1]
 
-            if not raw_key:
-                key = self.encode_key(key)
-
-            assert len(key) == self.key_size, 'Invalid key length'
+class BTreeKeyError(Exception):
+    def __init__(self, key, ctx=None):
+        super(BTreeKeyError, self).__init__(key, ctx)
+        self.key = key
+        self.ctx = ctx
 
-            nargs = (self, key) + args[2:]
-            return fn(*nargs, **kwargs)
-        except (BTreeKeyError, KeyError):
-            hex_key = binascii.hexlify(key)
-            if raw_key:
-                raise BTreeKeyError(hex_key)
-            else:
-                raise BTreeKeyError('%s (%s)' % (hex_key, args[1]))
-    return wrapper
+    def __str__(self):
+        # formatted lazily; most misses are caught and never printed
+        hex_key = binascii.hexlify(self.key).decode('ascii')
+        if self.ctx is None:
+            return hex_key
+        return '%s (%s)' % (hex_key, self.ctx)
 
 
 class BTreeDB4(SBBF03):
@@ -64,10 +50,17 @@ class BTreeDB4(SBBF03):
     that file format. In the future we may want to split away from the
     inheritance chain and instead use the SBBF02 file as an API.
     """
-    def __init__(self, path, page_count, read_only=False):
-        super(BTreeDB4, self).__init__(path, page_count, read_only=False)
+    # number of parsed index blocks to keep around
+    INDEX_CACHE_SIZE = 1024
+
+    # number of value locations to remember
+    VALUE_CACHE_SIZE = 4096
+
+    def __init__(self, path, page_count, read_only=False, max_pages=16):
+        super(BTreeDB4, self).__init__(path, page_count, read_only=False, max_pages=max_pages)
 
         self.key_size = None
+        self._index_entry = None
 
         # Set this attribute to True to make reading more forgiving.
         self.repair = False
@@ -76,6 +69,18 @@ class BTreeDB4(SBBF03):
         self.root_node = None
         self.root_node_is_leaf = None
 
+        # index blocks near the root are visited on every single lookup;
+        # keep the parsed ones around (least recently used first). The root
+        # and the blocks right below it (see __preload_index()) are kept
+        # outside of the LRU, where deeper levels can never evict them.
+        self._index_cache = OrderedDict()
+        self._root_index = None
+        self._pinned_index = dict()
+
+        # encoded key -> (leaf block, offset into leaf, value size) of values
+        # found recently, so looking them up again skips the leaf scan.
+        self._value_cache = OrderedDict()
+
         self.__load()
 
     def encode_key(self, key):
@@ -85,72 +90,124 @@ class BTreeDB4(SBBF03):
 
     def block(self, index):
         """Gets a block object given the specified index"""
+        if index == self.root_node and self._root_index is not None:
+            return self._root_index
+
+        block = self._pinned_index.get(index)
+        if block is not None:
+            return block
+
+        block = self._index_cache.get(index)
+        if block is not None:
+            self._index_cache.move_to_end(index)
+            return block
+
         region = self.block_region(index)
 
-        signature = bytes(region.read(2))
+        signature = region.read(2)
+
+        block_type = _block_types.get(signature)
+        if block_type is not None:
+            block = block_type(self, index, region)
+
+            # leaves are large and usually only read once; don't cache them
+            if isinstance(block, BTreeIndex):
+                if index == self.root_node:
+                    self._root_index = block
+                    return block
+
+                self._index_cache[index] = block
+                if len(self._index_cache) > self.INDEX_CACHE_SIZE:
+                    self._index_cache.popitem(last=False)
 
-        if signature in _block_types:
-            return _block_types[signature](self, index, region)
+            return block
 
-        if signature is not b'\0\0':
-            raise Exception('Invalid signature detected: %s', signature)
+        if signature != b'\0\0':
+            raise Exception('Invalid signature detected: %r' % signature)
 
         return None
 
-    @keyed
     def _leaf_for_key(self, key):
-        """Returns the binary data for the provided key."""
+        """Returns the leaf that would hold the provided (encoded) key."""
 
-        block = self.block(self.root_node)
-        assert block is not None, 'Root block is None'
+        pinned = self._pinned_index
+        cache = self._index_cache
 
-        # Scan down the B-tree until we reach a leaf.
+        block = self._root_index
+        if block is None:
+            block = self.block(self.root_node)
+
+        # Scan down the B-tree until we reach a leaf. Index blocks are almost
+        # always cached, so look there first and only go through block()
+        # (which reads the signature and dispatches on it) on a miss.
         while isinstance(block, BTreeIndex):
             block_number = block.block_for_key(key)
-            block = self.block(block_number)
+            block = pinned.get(block_number)
+            if block is not None:
+                continue
+            block = cache.get(block_number)
+            if block is None:
+                block = self.block(block_number)
+            else:
+                cache.move_to_end(block_number)
+
+        assert block is not None, 'Reached an empty block'
         assert isinstance(block, BTreeLeaf), 'Did not reach a leaf'
 
         return block
 
-    @keyed
-    def file_contents(self, key):
-        leaf = self._leaf_for_key(key, raw_key=True)
+    def _seek_value(self, key, raw_key):
+        """Finds a key's value, returning a LeafReader positioned at the start
+        of it along with its size. Values of other keys are never returned."""
+        encoded = key if raw_key else self.encode_key(key)
+        assert len(encoded) == self.key_size, 'Invalid key length'
+
+        value_cache = self._value_cache
+        location = value_cache.get(encoded)
+        if location is not None:
+            value_cache.move_to_end(encoded)
+            (leaf_index, offset, size) = location
+            return (LeafReader(self, self.block(leaf_index), offset), size)
+
+        leaf = self._leaf_for_key(encoded)
         stream = LeafReader(self, leaf)
+        key_size = self.key_size
 
         # The number of keys is read on-demand because only leaves pointed to
         # by an index contain this number (others just contain arbitrary data).
-        num_keys, = struct.unpack('>i', stream.read(4))
+        num_keys, = _INT.unpack(stream.read(_INT.size))
         assert num_keys < 1000, 'Leaf had unexpectedly high number of keys'
         for i in range(num_keys):
-            cur_key = stream.read(self.key_size)
-            # TODO do some smarter parsing here (read_bytes is easy to recreate
-            # using regions)
-            value = sbon.read_bytes(stream)
+            cur_key = stream.read_view(key_size)
+            size = stream.read_varlen_number()
 
-            if cur_key == key:
-                return value
+            if cur_key == encoded:
+                # restored leaves aren't what block() hands back; don't remember those
+                if type(stream._leaf) is BTreeLeaf:
+                    value_cache[encoded] = (stream._leaf.index, stream._offset, size)
+                    if len(value_cache) > self.VALUE_CACHE_SIZE:
+                        value_cache.popitem(last=False)
+                return (stream, size)
 
-        raise BTreeKeyError(key)
+            stream.skip(size)
 
-    @keyed
-    def file_size(self, key):
-        leaf = self._leaf_for_key(key, raw_key=True)
-        stream = LeafReader(self, leaf)
+        raise BTreeKeyError(encoded, None if raw_key else key)
 
-        # The number of keys is read on-demand because only leaves pointed to
-        # by an index contain this number (others just contain arbitrary data).
-        num_keys, = struct.unpack('>i', stream.read(4))
-        assert num_keys < 1000, 'Leaf had unexpectedly high number of keys'
-        for i in range(num_keys):
-            cur_key = stream.read(self.key_size)
-            # TODO do much better streaming here when LeafReader is refactored
-            size = sbon.read_varlen_number(stream)
-            stream.read(size)
+    def file_contents(self, key, raw_key=False):
+        (stream, size) = self._seek_value(key, raw_key)
+        return stream.read(size)
 
-            if cur_key == key:
-                return size
+    def file_size(self, key, raw_key=False):
+        # sizes are asked for all the time (every getattr); if the value's
+        # location is known, so is its size, and the leaf needn't be touched
+        encoded = key if raw_key else self.encode_key(key)
+        location = self._value_cache.get(encoded)
+        if location is not None:
+            self._value_cache.move_to_end(encoded)
+            return location[2]
 
-        raise BTreeKeyError(key)
+        (_, size) = self._seek_value(key, raw_key)
+        return size
 
     def __load(self):
         stream = self.user_header
@@ -164,10 +221,13 @@ class BTreeDB4(SBBF03):
         self.identifier = sbon.read_fixlen_string(stream, 12)
         log.info('database name: %s', self.identifier)
 
-        fields = struct.unpack('>i?xi?xxxi?', stream.read(19))
+        fields = _DB_FIELDS.unpack(stream.read(_DB_FIELDS.size))
         self.key_size = fields[0]
         log.debug('key size=%d', self.key_size)
 
+        # index entries are a key followed by a block number
+        self._index_entry = struct.Struct('>%dsi' % self.key_size)
+
         # Whether to use the alternate root node index.
         self.alternate_root_node = fields[1]
         if self.alternate_root_node:
@@ -178,6 +238,37 @@ class BTreeDB4(SBBF03):
             self.other_root_node, self.other_root_node_is_leaf = fields[4:6]
         log.debug('loaded root nodes: root=%d isleaf=%r', self.root_node, self.root_node_is_leaf)
 
+        self.__preload_index()
+
+    def __preload_index(self):
+        """Parses and pins the root index block and the index blocks right below it
+
+        Every lookup goes through the root and one of its children, so
+        there's no point waiting for the first few lookups to fault them in
+        one at a time. Each child only sees a share of the lookups, so in a
+        big index the LRU would let the levels below push the colder ones
+        out; they're kept aside instead, where they're never evicted."""
+        self._root_index = None
+        self._pinned_index = dict()
+        if self.root_node_is_leaf:
+            return
+
+        root = self.block(self.root_node)
+        if not isinstance(root, BTreeIndex) or root.level == 0:
+            # level 0 indexes point straight at leaves, which aren't cached
+            return
+
+        for child in root.values:
+            self.prefetch_block(child)
+
+        pinned = dict()
+        for child in root.values:
+            block = self.block(child)
+            if isinstance(block, BTreeIndex):
+                pinned[child] = self._index_cache.pop(child)
+        self._pinned_index = pinned
+        log.debug('pinned %d index blocks below the root', len(pinned))
+
 
 class BTreeBlock(object):
     def __init__(self, btree, index, region):
@@ -193,17 +284,20 @@ class BTreeIndex(BTreeBlock):
 
     def __init__(self, btree, index, region):
         super(BTreeIndex, self).__init__(btree, index, region)
-        self.level, self.num_keys, left_block = struct.unpack('>Bii', self.block_region.read(9))
+        # parse the header and the table straight out of the mapped block
+        body = self.block_region.view(btree._block_size - 2)
+        self.level, self.num_keys, left_block = _INDEX_HEADER.unpack_from(body)
 
         self.keys = []
         self.values = [left_block]
 
-        for i in range(self.num_keys):
-            key = self.block_region.read(btree.key_size)
-            block, = struct.unpack('>i', self.block_region.read(4))
-
-            self.keys.append(key)
-            self.values.append(block)
+        if self.num_keys > 0:
+            entry = btree._index_entry
+            start = _INDEX_HEADER.size
+            table = body[start:start + self.num_keys * entry.size]
+            for (key, block) in entry.iter_unpack(table):
+                self.keys.append(key)
+                self.values.append(block)
 
     def __str__(self):
         return 'Index(level={}, num_keys={})'.format(self.level, self.num_keys)
@@ -220,10 +314,13 @@ class BTreeLeaf(BTreeBlock):
 
     def __init__(self, btree, index, region):
         super(BTreeLeaf, self).__init__(btree, index, region)
-        # Substract 6 for signature and next_block.
-        self.data = self.block_region.read(btree._block_size - 6)
+        # This is a view straight into the mapped block; nothing is copied.
+        body = self.block_region.view(btree._block_size - 2)
+
+        # The last 4 bytes are next_block.
+        self.data = body[:-_INT.size]
 
-        value, = struct.unpack('>i', self.block_region.read(4))
+        value, = _INT.unpack_from(body, len(body) - _INT.size)
         self.next_block = value if value != -1 else None
 
     def __str__(self):
@@ -237,8 +334,9 @@ class BTreeFree(BTreeBlock):
 
     def __init__(self, btree, index, region):
         super(BTreeFree, self).__init__(btree, index, region)
-        self.raw_data = self.block_region.region()
-        value, = struct.unpack('>i', self.raw_data[:4])
+        # a view of everything after the signature; nothing is copied
+        self.raw_data = self.block_region.view()
+        value, = _INT.unpack_from(self.raw_data)
         self.next_free_block = value if value != -1 else None
 
     def __str__(self):
@@ -248,9 +346,10 @@ class BTreeFree(BTreeBlock):
 class BTreeRestoredLeaf(BTreeLeaf):
     def __init__(self, free_block):
         assert isinstance(free_block, BTreeFree), 'Expected free block'
-        self.data = free_block.raw_data[:-4]
+        self.index = free_block.index
+        self.data = free_block.raw_data[:-_INT.size]
 
-        value, = struct.unpack('>i', free_block.raw_data[-4:])
+        value, = _INT.unpack_from(free_block.raw_data, len(free_block.raw_data) - _INT.size)
         self.next_block = value if value != -1 else None
 
     def __str__(self):
@@ -261,57 +360,144 @@ class LeafReader(object):
     """A pseudo-reader that will cross over block boundaries if necessary."""
     __slots__ = ['_file', '_leaf', '_offset', '_visited']
 
-    def __init__(self, file, leaf):
+    def __init__(self, file, leaf, offset=0):
         assert isinstance(file, BTreeDB4), 'File is not a BTreeDB4 instance'
         assert isinstance(leaf, BTreeLeaf), 'Leaf is not a BTreeLeaf instance'
 
         self._file = file
         self._leaf = leaf
-        self._offset = 0
-        self._visited = [leaf.index]
+        self._offset = offset
+        self._visited = {leaf.index}
 
     def read(self, length):
         offset = self._offset
 
         if offset + length <= len(self._leaf.data):
             self._offset += length
-            return self._leaf.data[offset:offset + length]
+            return bytes(self._leaf.data[offset:offset + length])
 
-        buffer = io.BytesIO()
+        # We know exactly how much we're going to read, so fill a single
+        # buffer in place instead of growing one as we go.
+        buffer = bytearray(length)
+        view = memoryview(buffer)
+
+        # Bind everything the loop below touches to locals up front.
+        leaf = self._leaf
+        data = leaf.data
+        block = self._file.block
+        repair = self._file.repair
+        visited = self._visited
 
         # If the file is in repair mode, make the buffer available globally.
-        if self._file.repair:
+        if repair:
             LeafReader.last_buffer = buffer
 
         # Exhaust current leaf.
-        num_read = buffer.write(self._leaf.data[offset:])
+        num_read = len(data) - offset
+        view[:num_read] = data[offset:]
+        pos = num_read
         length -= num_read
 
         # Keep moving onto the next leaf until we have read the desired amount.
         while length > 0:
-            next_block = self._leaf.next_block
+            next_block = leaf.next_block
 
             assert next_block is not None, 'Tried to read too far'
-            assert next_block not in self._visited, 'Tried to read visited block'
-            self._visited.append(next_block)
+            assert next_block not in visited, 'Tried to read visited block'
+            visited.add(next_block)
+
+            leaf = block(next_block)
+            if repair and isinstance(leaf, BTreeFree):
+                leaf = BTreeRestoredLeaf(leaf)
 
-            self._leaf = self._file.block(next_block)
-            if self._file.repair and isinstance(self._leaf, BTreeFree):
-                self._leaf = BTreeRestoredLeaf(self._leaf)
+            assert isinstance(leaf, BTreeLeaf), \
+                'Leaf pointed to non-leaf %s after reading %d byte(s)' % (next_block, pos)
 
-            assert isinstance(self._leaf, BTreeLeaf), \
-                'Leaf pointed to non-leaf %s after reading %d byte(s)' % (next_block, buffer.tell())
+            data = leaf.data
 
-            num_read = buffer.write(self._leaf.data[:length])
+            num_read = min(length, len(data))
+            view[pos:pos + num_read] = data[:num_read]
+            pos += num_read
             length -= num_read
 
         # The new offset will be how much was read from the current leaf.
+        self._leaf = leaf
         self._offset = num_read
 
-        data = buffer.getvalue()
-        buffer.close()
+        view.release()
+        return bytes(buffer)
+
+    def read_view(self, length):
+        """Like read, but returns a view into the leaf rather than a copy when
+        the bytes don't cross into another leaf"""
+        offset = self._offset
+        end = offset + length
+        data = self._leaf.data
 
-        return data
+        if end <= len(data):
+            self._offset = end
+            return data[offset:end]
+
+        return self.read(length)
+
+    def skip(self, length):
+        """Moves forward the given number of bytes without reading them"""
+        offset = self._offset + length
+        leaf = self._leaf
+
+        if offset <= len(leaf.data):
+            self._offset = offset
+            return
+
+        block = self._file.block
+        repair = self._file.repair
+        visited = self._visited
+
+        # Walk the chain of leaves until the offset lands inside one.
+        offset -= len(leaf.data)
+        while True:
+            next_block = leaf.next_block
+
+            assert next_block is not None, 'Tried to skip too far'
+            assert next_block not in visited, 'Tried to skip to visited block'
+            visited.add(next_block)
+
+            leaf = block(next_block)
+            if repair and isinstance(leaf, BTreeFree):
+                leaf = BTreeRestoredLeaf(leaf)
+
+            assert isinstance(leaf, BTreeLeaf), \
+                'Leaf pointed to non-leaf %s while skipping' % next_block
+
+            if offset <= len(leaf.data):
+                break
+            offset -= len(leaf.data)
+
+        self._leaf = leaf
+        self._offset = offset
+
+    def read_varlen_number(self):
+        """Same as sbon.read_varlen_number, but decodes straight out of the
+        leaf's data rather than reading one byte at a time"""
+        data = self._leaf.data
+        offset = self._offset
+        end = len(data)
+        value = 0
+        while offset < end:
+            byte = data[offset]
+            offset += 1
+            if not byte & 0b10000000:
+                self._offset = offset
+                return value << 7 | byte
+            value = value << 7 | (byte & 0b01111111)
+
+        # the number runs over into the next leaf
+        self._offset = offset
+        while True:
+            byte = ord(self.read(1))
+            if not byte & 0b10000000:
+                return value << 7 | byte
+            value = value << 7 | (byte & 0b01111111)
 
 _block_types = {
     BTreeIndex.SIGNATURE: BTreeIndex,
@@ -4,21 +4,36 @@ Note that this implementation supports asset pakfiles (including modpak files)
 that are keyed with SHA256 digests for StarBound. It will not work with anything else.
 """
 
+import bisect
+import gc
+import os
 import hashlib
 import io
 import logging
+import marshal
+from collections import OrderedDict
 
 import starfuse.pak.sbon as sbon
 from starfuse.pak.btreedb4 import BTreeDB4
+from starfuse.fs.mapped_file import MADV_RANDOM, MADV_SEQUENTIAL
 from starfuse.fs.vfs import VFS, FileNotFoundError, IsADirError, NotADirError
 
 log = logging.getLogger(__name__)
 
+# appended to the pakfile's path to get the path of its index cache
+INDEX_CACHE_SUFFIX = '.vfs.cache'
+
+# hashlib.sha256 is backed by OpenSSL (which uses the SHA extensions where
+# the CPU has them); bind it once rather than looking it up on every key.
+_sha256 = hashlib.sha256
+
 
 class KeyStore(BTreeDB4):
     """A B-tree database that uses SHA-256 hashes for key lookup."""
     def encode_key(self, key):
-        return hashlib.sha256(key.encode('utf-8')).digest()
+        if not isinstance(key, bytes):
+            key = key.encode('utf-8')
+        return _sha256(key).digest()
 
 
 class Package(KeyStore):
@@ -26,12 +41,25 @@ class Package(KeyStore):
     DIGEST_KEY = '_digest'
     INDEX_KEY = '_index'
 
-    def __init__(self, path, page_count, read_only=False):
-        super(Package, self).__init__(path, page_count, read_only=read_only)
+    def __init__(self, path, page_count, read_only=False, max_pages=16):
+        # path -> digest; Pakfile only ever asks for files by their canonical
+        # path, so this is bounded by the number of files in the package.
+        self._key_cache = dict()
+        super(Package, self).__init__(path, page_count, read_only=read_only, max_pages=max_pages)
         self._index = None
 
     def encode_key(self, key):
-        return super(Package, self).encode_key(key.lower())
+        digest = self._key_cache.get(key)
+        if digest is None:
+            try:
+                # asset paths are practically always ASCII, and lowercasing
+                # bytes is a lot cheaper than lowercasing unicode
+                lowered = key.encode('ascii').lower()
+            except UnicodeEncodeError:
+                lowered = key.lower().encode('utf-8')
+            digest = super(Package, self).encode_key(lowered)
+            self._key_cache[key] = digest
+        return digest
 
     def get_digest(self):
         return self.get(Package.DIGEST_KEY)
@@ -51,17 +79,154 @@ class Package(KeyStore):
 
 
 class Pakfile(object):
-    def __init__(self, path, page_count, read_only=False):
+    __slots__ = ['_contents_cache', '_contents_cache_bytes', '_contents_cache_size', '_entries',
+                 '_listing_cache', '_sorted_paths', 'pkg', 'vfs']
+
+    # default total size (in bytes) of the file contents to keep cached
+    CONTENTS_CACHE_SIZE = 64 * 1024 * 1024
+
+    def __init__(self, path, page_count, read_only=False, max_pages=16, index_cache=False, cache_size=None):
+        # FUSE reads files a chunk at a time; keep recently read files
+        # around (least recently used first) so each chunk doesn't have to
+        # go back through the B-tree.
+        self._contents_cache = OrderedDict()
+        self._contents_cache_bytes = 0
+        self._contents_cache_size = self.CONTENTS_CACHE_SIZE if cache_size is None else cache_size
+
+        # id(directory dict) -> directory_listing(); directories never change
+        # once the tree is built, so each one only has to be listed once
+        self._listing_cache = dict()
+
         self.vfs = VFS()
-        self.pkg = Package(path, page_count, read_only=False)
+        self.pkg = Package(path, page_count, read_only=False, max_pages=max_pages)
+
+        if not (index_cache and self._load_index_cache(path)):
+            self._register_files()
+            if index_cache:
+                self._save_index_cache(path)
+
+        # FUSE resolves the same paths over and over (every getattr, open and
+        # read), and the tree never changes once it's built; resolve every
+        # path in it once, up front.
+        self._entries = self._resolve_all_entries()
 
+        # every path in sorted order, so the paths under a directory sit side
+        # by side; built the first time a directory is listed
+        self._sorted_paths = None
+
+    def _register_files(self):
+        """Builds the VFS from the package's file index"""
         log.debug('obtaining file list')
-        file_index = self.pkg.get_index()
+        # the index is read front to back through its chain of leaves; let
+        # the kernel read ahead while it is, then go back to random access.
+        self.pkg.access_pattern(MADV_SEQUENTIAL)
+        try:
+            file_index = self.pkg.get_index()
+        finally:
+            self.pkg.access_pattern(MADV_RANDOM)
         log.debug('registering files with virtual filesystem')
-        for filepath, lookup in file_index.iteritems():
-            self.vfs.add_file(filepath, lookup, mkdirs=True)
+        if isinstance(file_index, dict):
+            files = file_index.items()
+        else:
+            files = ((filepath, None) for filepath in file_index)
+        self.vfs.add_files(files)
         log.info('registered %d files with virtual filesystem', len(file_index))
 
+    def _resolve_all_entries(self):
+        """Maps every path in the VFS to what entry() returns for it"""
+        root = self.vfs.root
+        entries = {'/': (root, None, root, False)}
+
+        pending = [('', root)]
+        while pending:
+            (dirpath, direc) = pending.pop()
+            for (name, lookup) in direc.items():
+                abspath = dirpath + '/' + name
+                isdir = isinstance(lookup, dict)
+                entries[abspath] = (direc, name, lookup, not isdir)
+                if isdir:
+                    pending.append((abspath, lookup))
+
+        return entries
+
+    @staticmethod
+    def _fingerprint(path):
+        stat = os.stat(path)
+        return (stat.st_size, stat.st_mtime)
+
+    def _load_index_cache(self, path):
+        """Loads the VFS from the index cache, if there's a fresh one"""
+        cache_path = path + INDEX_CACHE_SUFFIX
+        try:
+            with open(cache_path, 'rb') as f:
+                # the tree is nothing but dicts; don't let the collector
+                # repeatedly walk it while it's being built
+                gc_enabled = gc.isenabled()
+                gc.disable()
+                try:
+                    # marshal (unlike pickle) can't be made to run code by
+                    # whoever managed to put a file next to the pak
+                    data = marshal.load(f)
+                finally:
+                    if gc_enabled:
+                        gc.enable()
+        except Exception as e:
+            # missing, unreadable, truncated or just not ours; rebuild it
+            log.debug('not using index cache %s: %s', cache_path, e)
+            return False
+
+        if not (type(data) is tuple and len(data) == 2 and self._is_vfs_tree(data[1])):
+            log.warning('ignoring malformed index cache: %s', cache_path)
+            return False
+
+        (fingerprint, root) = data
+
+        if fingerprint != self._fingerprint(path):
+            log.info('index cache is stale: %s', cache_path)
+            return False
+
+        self.vfs.root = root
+        log.info('loaded virtual filesystem from index cache: %s', cache_path)
+        return True
+
+    def _save_index_cache(self, path):
+        """Saves the VFS to the index cache so later mounts can skip building it"""
+        cache_path = path + INDEX_CACHE_SUFFIX
+
+        # write it somewhere else first and move it into place, so a crash
+        # halfway through never leaves a truncated cache behind
+        temp_path = '%s.%d.tmp' % (cache_path, os.getpid())
+        try:
+            with open(temp_path, 'wb') as f:
+                marshal.dump((self._fingerprint(path), self.vfs.root), f)
+            os.replace(temp_path, cache_path)
+        except (IOError, OSError, ValueError) as e:
+            log.warning('could not write index cache %s: %s', cache_path, e)
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            return
+        log.info('wrote index cache: %s', cache_path)
+
+    @staticmethod
+    def _is_vfs_tree(root):
+        """Checks that a loaded tree has the shape the VFS builds"""
+        if type(root) is not dict:
+            return False
+
+        pending = [root]
+        while pending:
+            direc = pending.pop()
+            for (name, lookup) in direc.items():
+                if type(name) is not str or not name:
+                    return False
+                if type(lookup) is dict:
+                    pending.append(lookup)
+                elif lookup is not None and type(lookup) is not bytes:
+                    return False
+        return True
+
     @property
     def read_only(self):
         return self.pkg.read_only
@@ -71,19 +236,35 @@ class Pakfile(object):
         self.pkg.read_only = val
 
     def entry(self, abspath):
+        result = self._entries.get(abspath)
+        if result is None:
+            # not a path as FUSE would spell it; this also raises the right
+            # error for paths that don't exist
+            result = self._resolve_entry(abspath)
+        return result
+
+    def _resolve_entry(self, abspath):
         if abspath is None or abspath == '/':
             return (self.vfs.root, None, self.vfs.root, False)
 
         names = self.vfs._split_path(abspath)
-        direc = self.vfs._mkdirp(names[:-1], srcpath=abspath, mkdirs=False)
+        fname = names.pop()
 
-        fname = names[-1]
+        # walk down to the containing directory
+        direc = self.vfs.root
+        for name in names:
+            try:
+                direc = direc[name]
+            except KeyError:
+                raise FileNotFoundError(abspath)
+            if type(direc) is not dict:
+                raise NotADirError(abspath)
 
-        if fname not in direc:
+        try:
+            entry = direc[fname]
+        except KeyError:
             raise FileNotFoundError(abspath)
 
-        entry = direc[fname]
-
         # (directory dict, filename, lookup entry, True if file, False if directory)
         return (direc, fname, entry, not isinstance(entry, dict))
 
@@ -91,26 +272,96 @@ class Pakfile(object):
         (_, _, lookup, isfile) = self.entry(abspath)
         if isfile:
             raise NotADirError(abspath)
-        return lookup.keys()
 
-    def file_size(self, abspath):
-        (_, _, _, isfile) = self.entry(abspath)
-        if not isfile:
+        listing = self._listing_cache.get(id(lookup))
+        if listing is None:
+            listing = self._listing_cache[id(lookup)] = self._list_prefix(self._canonical_path(abspath))
+        return listing
+
+    def _list_prefix(self, dirpath):
+        """Lists the names in a directory, in sorted order, by bisecting the
+        sorted path list for everything under it"""
+        paths = self._sorted_paths
+        if paths is None:
+            paths = self._sorted_paths = sorted(self._entries)
+
+        prefix = dirpath.rstrip('/') + '/'
+        start = len(prefix)
+        lo = bisect.bisect_right(paths, prefix)
+        hi = bisect.bisect_right(paths, prefix + '\U0010ffff', lo)
+
+        names = []
+        while lo < hi:
+            (name, sep, _) = paths[lo][start:].partition('/')
+            if sep:
+                # inside a subdirectory that's already been listed; skip the
+                # rest of it in one go ('0' is the character right after '/')
+                lo = bisect.bisect_left(paths, prefix + name + '0', lo, hi)
+            else:
+                names.append(name)
+                lo += 1
+        return names
+
+    def _canonical_path(self, abspath):
+        """Gets the path something is keyed by everywhere, however it was spelled"""
+        if abspath in self._entries:
+            return abspath
+        return '/' + '/'.join(self.vfs._split_path(abspath))
+
+    def _resolve_file(self, abspath):
+        """Makes sure abspath is a file, raising if it's anything else, and
+        returns its canonical path (the one it's keyed by everywhere)"""
+        entry = self._entries.get(abspath)
+        if entry is None:
+            entry = self._resolve_entry(abspath)
+            abspath = self._canonical_path(abspath)
+        if not entry[3]:
             raise IsADirError(abspath)
+        return abspath
+
+    def file_size(self, abspath):
+        # files that have been read recently already know their size (and
+        # only files ever make it into the cache)
+        data = self._contents_cache.get(abspath)
+        if data is not None:
+            return len(data)
+
+        abspath = self._resolve_file(abspath)
+        data = self._contents_cache.get(abspath)
+        if data is not None:
+            return len(data)
         return self.pkg.file_size(abspath)
 
     def file_contents(self, abspath, offset=0, size=-1):
-        (_, _, _, isfile) = self.entry(abspath)
-        if not isfile:
-            raise IsADirError(abspath)
-        return self.pkg.file_contents(abspath)[offset:offset + size]
+        # FUSE reads files a chunk at a time; the chunks after the first are
+        # served straight from the cache without resolving the path again
+        data = self._contents_cache.get(abspath)
+        if data is not None:
+            self._contents_cache.move_to_end(abspath)
+        else:
+            data = self._load_contents(self._resolve_file(abspath))
 
-    def readdir(self, abspath):
-        (_, _, lookup, isfile) = self.entry(abspath)
-        if isfile:
-            raise NotADirError(abspath)
+        if size < 0:
+            # the whole thing (or the rest of it) was asked for
+            return data if offset == 0 else data[offset:]
+        return data[offset:offset + size]
+
+    def _load_contents(self, abspath):
+        """Reads a file's contents from the package (by its canonical path),
+        caching them if they fit"""
+        data = self._contents_cache.get(abspath)
+        if data is not None:
+            self._contents_cache.move_to_end(abspath)
+            return data
+
+        data = self.pkg.file_contents(abspath)
+
+        # really big files would just flush everything else out
+        if len(data) <= self._contents_cache_size // 8:
+            self._contents_cache[abspath] = data
+            self._contents_cache_bytes += len(data)
+            while self._contents_cache_bytes > self._contents_cache_size:
+                (_, old) = self._contents_cache.popitem(last=False)
+                self._contents_cache_bytes -= len(old)
 
-        results = []
-        for name, lobj in lookup.iteritems():
-            results.append((name, not isinstance(lobj, dict)))
-        return results
+        return data
@@ -7,6 +7,9 @@ from starfuse.fs.mapped_file import MappedFile
 
 log = logging.getLogger(__name__)
 
+# header size, block size
+_HEADER_SIZES = struct.Struct('>ii')
+
 
 class InvalidMagic(Exception):
     """A block file has an invalid magic string"""
@@ -21,8 +24,8 @@ class SBBF03(MappedFile):
 
     It's worth noting that the memory regions in this class are mapped and not
     read-in."""
-    def __init__(self, path, page_count, read_only=False):
-        super(SBBF03, self).__init__(path, page_count, read_only=read_only)
+    def __init__(self, path, page_count, read_only=False, max_pages=16):
+        super(SBBF03, self).__init__(path, page_count, read_only=read_only, max_pages=max_pages)
 
         self._header_size = 0
         self._block_size = 0
@@ -41,6 +44,10 @@ class SBBF03(MappedFile):
         base_offset = self._header_size + (self._block_size * bid)
         return self.region(offset=base_offset, size=self._block_size)
 
+    def prefetch_block(self, bid):
+        """Asks the kernel to start paging in a block we're about to need"""
+        self.prefetch(self._header_size + (self._block_size * bid), self._block_size)
+
     @property
     def block_count(self):
         block_region_size = len(self) - self._header_size
@@ -60,7 +67,7 @@ class SBBF03(MappedFile):
         # this is all we need to actually read from the file before we start mmap-ing.
         # this is because we want to be able to mmap the header as well, and all we need to know
         # are the header sizes and block sizes.
-        (self._header_size, self._block_size) = struct.unpack('>ii', region.read(8))
+        (self._header_size, self._block_size) = _HEADER_SIZES.unpack(region.read(_HEADER_SIZES.size))
         log.debug('header_size=%d, block_size=%d', self._header_size, self._block_size)
 
         # calculate number of blocks
@@ -68,7 +75,6 @@ class SBBF03(MappedFile):
 
         # map header
         self.header = self.region(offset=0, size=self._header_size)
-        self.user_header = self.header.region(0x20)
 
         # map user header
         self.user_header = self.header.region(offset=0x20)